@@ -22,69 +22,68 @@
 
 import os
 import sys
+import errno
+import mmap
 import struct
+import functools
 
+from bisect import bisect_right
 from stat import *
-from fuse import FUSE, Operations
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from fuse import FUSE, FuseOSError, Operations
 
-BLOCK_SIZE = int(512)
+BLOCK_SIZE: int = 512
 
-def VMStoUNIX(timestamp):
+_FILEID_S = struct.Struct('<HHBB')
+_DIRENT_S = struct.Struct('<2xHHBB')
+_DIRREC_S = struct.Struct('<HHBB')
+_FILE_S = struct.Struct('<BBBBHH6s6s32sI2xB')
+_IDENT_S = struct.Struct('<20sHQQQQ66s')
+# Only the home block fields that are used: L_IBMAPLBN, W_IBMAPSIZE,
+# W_RESFILES and the four name strings
+_HOME_S = struct.Struct('<24xI4xHH424x12s12s12s12s')
+
+def VMStoUNIX(timestamp: int) -> float:
     # VMS Timestamp of Jan 1, 1970
     offset = 35067168003000000
     return (timestamp - 35067168003000000) / 1e7
 
-class FileID:
-    FORMAT = '<HHBB'
-    SIZE = struct.calcsize(FORMAT)
+class FileID(NamedTuple):
+    file_number: int
+    sequence_number: int
+    relative_volume_number: int
 
-    def __init__(self, disk):
+    @classmethod
+    def unpack_from(cls, disk: bytes, offset: int = 0) -> 'FileID':
         (
             W_NUM,
             W_SEQ,
             B_RVN,
             B_NMX,
-        ) = struct.unpack_from(self.FORMAT, disk)
+        ) = _FILEID_S.unpack_from(disk, offset)
 
-        self.file_number = (B_NMX << 16) | W_NUM
-        self.sequence_number = W_SEQ
-        self.relative_volume_number = B_RVN
+        return cls((B_NMX << 16) | W_NUM, W_SEQ, B_RVN)
 
-    def __repr__(self):
+    def __repr__(self) -> str:
         return "{}/{}".format(self.file_number, self.sequence_number)
 
-class DirectoryEntry:
-    FORMAT = '<H6s'
-    SIZE = struct.calcsize(FORMAT)
-
-    def __init__(self, disk, offset):
-        (
-            W_VERSION,
-            W_FID,
-        ) = struct.unpack_from(self.FORMAT, disk, offset)
-
-        self.fid = FileID(W_FID)
-
-    def __repr__(self):
-        return repr(self.fid)
-
 class DirectoryRecord:
-    def __init__(self, disk, offset):
-        FORMAT = '<HHBB'
+    def __init__(self, disk: memoryview, offset: int) -> None:
         (
             W_SIZE,
             W_VERLIMIT,
             B_FLAGS,
             B_NAMECOUNT,
-        ) = struct.unpack_from(FORMAT, disk, offset)
-        offset += struct.calcsize(FORMAT)
+        ) = _DIRREC_S.unpack_from(disk, offset)
+        offset += _DIRREC_S.size
 
-        self.size = W_SIZE + 2
+        self.size: int = W_SIZE + 2
 
         T_NAME = disk[offset:offset + B_NAMECOUNT]
         offset += B_NAMECOUNT
 
-        self.name = T_NAME.decode("ascii")
+        # Decode straight from the view, without an intermediate bytes copy
+        self.name: str = str(T_NAME, "ascii")
         if self.name.endswith('.'):
             self.name = self.name[:-1]
             
@@ -92,15 +91,33 @@ class DirectoryRecord:
         if (offset & 1) == 1:
             offset += 1
 
-        self.entries = []
-        entries_count = int((self.size - B_NAMECOUNT) / DirectoryEntry.SIZE)
-        for i in range(entries_count):
-            self.entries.append(DirectoryEntry(disk, offset))
-            offset += DirectoryEntry.SIZE
+        # (W_VERSION, W_FID) pairs, one per version of the file. W_VERSION
+        # is skipped and the FID fields are unpacked in place.
+        entries_count = (self.size - B_NAMECOUNT) // _DIRENT_S.size
+        entries_end = offset + (entries_count * _DIRENT_S.size)
+        self.entries: List[FileID] = [
+            FileID((B_NMX << 16) | W_NUM, W_SEQ, B_RVN)
+            for W_NUM, W_SEQ, B_RVN, B_NMX in _DIRENT_S.iter_unpack(disk[offset:entries_end])
+        ]
+
+def read_directory_block(disk: memoryview, offset: int) -> List[DirectoryRecord]:
+    """Parse the records of the directory block at offset, up to the
+    end-of-block marker (a negative record size)."""
+    records: List[DirectoryRecord] = []
+    append = records.append
+    for i in range(62):
+        # Sign bit of the little-endian record size
+        if disk[offset + 1] & 0x80:
+            break
+
+        record = DirectoryRecord(disk, offset)
+        offset += record.size
+
+        append(record)
+    return records
 
 class File:
-    def __init__(self, disk, offset):
-        FORMAT = '<BBBBHH6s6s32sI2xB'
+    def __init__(self, disk: memoryview, offset: int) -> None:
         (
             B_IDOFFSET,
             B_MPOFFSET,
@@ -113,30 +130,37 @@ class File:
             W_RECATTR,
             L_FILECHAR,
             B_MAP_INUSE,
-        ) = struct.unpack_from(FORMAT, disk, offset)
+        ) = _FILE_S.unpack_from(disk, offset)
 
-        self.fid = FileID(W_FID)
-        self.ext_fid = FileID(W_EXT_FID)
+        self.fid: FileID = FileID.unpack_from(W_FID)
+        self.ext_fid: FileID = FileID.unpack_from(W_EXT_FID)
 
-        self.is_directory = (L_FILECHAR & 8192) == 8192
+        self.is_directory: bool = (L_FILECHAR & 8192) == 8192
 
-        self.create_time = 0
-        self.revision_time = 0
+        self.name: str = ''
+        self.create_time: float = 0
+        self.revision_time: float = 0
         if B_IDOFFSET != 0xFF:
             self.read_ident(disk, offset + (B_IDOFFSET * 2))
         
-        self.map = []
-        self.total_block_count = 0
-        self.size = BLOCK_SIZE # ?
+        # Retrieval pointers, one entry per extent in each list. map_base
+        # holds the running block count starting from 0, so extent i covers
+        # VBNs map_base[i]+1 through map_base[i+1].
+        self.map_lbn: List[int] = []
+        self.map_block_count: List[int] = []
+        self.map_base: List[int] = [0]
+        self.total_block_count: int = 0
+        self.size: int = BLOCK_SIZE # ?
         if B_MPOFFSET != 0xFF:
             self.read_map(disk, offset + (B_MPOFFSET * 2), B_MAP_INUSE)
 
-        self.records = []
-        if self.is_directory:
-            self.read_directory_records(disk)
+        # Directory records are read on first use, see load_records()
+        self.disk: memoryview = disk
+        self.records_loaded: bool = False
+        self.records: List[DirectoryRecord] = []
+        self.records_by_name: Dict[str, DirectoryRecord] = {}
     
-    def read_ident(self, disk, offset):
-        FORMAT = '<20sHQQQQ66s'
+    def read_ident(self, disk: memoryview, offset: int) -> None:
         (
             T_FILENAME,
             W_REVISION,
@@ -145,7 +169,7 @@ class File:
             Q_EXPDATE,
             Q_BAKDATE,
             T_FILENAMEEXT,
-        ) = struct.unpack_from(FORMAT, disk, offset)
+        ) = _IDENT_S.unpack_from(disk, offset)
 
         self.create_time = VMStoUNIX(Q_CREATE)
         self.revision_time = VMStoUNIX(Q_REVDATE)
@@ -155,7 +179,7 @@ class File:
         if self.name.endswith('.'):
             self.name = self.name[:-1]
 
-    def read_map(self, disk, offset, B_MAP_INUSE):
+    def read_map(self, disk: memoryview, offset: int, B_MAP_INUSE: int) -> None:
         end_offset = offset + (B_MAP_INUSE * 2)
 
         while offset < end_offset:
@@ -165,153 +189,148 @@ class File:
             lbn = 0
 
             if V_FORMAT == 0:
-                (
-                    W_WORD0,
-                ) = struct.unpack_from('<H', disk, offset)
                 offset += 2
 
                 print("V_FORMAT == 0, unsupported")
 
             elif V_FORMAT == 1:
-                (
-                    B_COUNT1,
-                    V_HIGHLBN,
-                    W_LOWLBN,
-                ) = struct.unpack_from('<BBH', disk, offset)
-                offset += 4
-
+                B_COUNT1 = disk[offset]
                 # Mask V_FORMAT
-                V_HIGHLBN &= 0x3F
+                V_HIGHLBN = disk[offset + 1] & 0x3F
+                W_LOWLBN = int.from_bytes(disk[offset + 2:offset + 4], 'little')
+                offset += 4
 
                 block_count = B_COUNT1
                 lbn = (V_HIGHLBN << 16) | W_LOWLBN
 
             elif V_FORMAT == 2:
-                (
-                    V_COUNT2,
-                    W_LBN2,
-                ) = struct.unpack_from('<HH', disk, offset)
-                offset += 6
-
                 # Mask V_FORMAT
-                V_COUNT2 &= 0x3FFF
+                V_COUNT2 = int.from_bytes(disk[offset:offset + 2], 'little') & 0x3FFF
+                L_LBN2 = int.from_bytes(disk[offset + 2:offset + 6], 'little')
+                offset += 6
 
                 block_count = V_COUNT2
-                lbn = W_LBN2
+                lbn = L_LBN2
 
             elif V_FORMAT == 3:
-                (
-                    V_COUNT2,
-                    W_LOWCOUNT,
-                    L_LBN3,
-                ) = struct.unpack_from('BBH', disk, offset)
-                offset += 8
-
                 # Mask V_FORMAT
-                V_COUNT2 &= 0x3FFF
+                V_COUNT2 = int.from_bytes(disk[offset:offset + 2], 'little') & 0x3FFF
+                W_LOWCOUNT = int.from_bytes(disk[offset + 2:offset + 4], 'little')
+                L_LBN3 = int.from_bytes(disk[offset + 4:offset + 8], 'little')
+                offset += 8
 
                 block_count = (V_COUNT2 << 16) | W_LOWCOUNT
                 lbn = L_LBN3
 
-            self.map.append({
-                'lbn': lbn,
-                'block_count': block_count + 1,
-            })
+            self.map_lbn.append(lbn)
+            self.map_block_count.append(block_count + 1)
+            self.map_base.append(self.map_base[-1] + block_count + 1)
             self.total_block_count += block_count
 
         self.size = self.total_block_count * BLOCK_SIZE
 
-    def read_directory_records(self, disk):
-        for vbn in range(1, self.total_block_count):
-            lbn = self.get_lbn_for_vbn(vbn)
-            offset = lbn * BLOCK_SIZE
-            for i in range(62):
-                ( record_size, ) = struct.unpack_from('h', disk, offset)
-                if record_size < 0:
-                    break
+    def read_directory_records(self, disk: memoryview) -> None:
+        for offset in self.get_block_offsets(1, self.total_block_count - 1):
+            records = read_directory_block(disk, offset)
 
-                record = DirectoryRecord(disk, offset)
-                offset += record.size
+            self.records.extend(records)
+            for record in records:
+                self.records_by_name.setdefault(record.name, record)
 
-                self.records.append(record)
+    def skip_extents(self, count: int) -> None:
+        skipped = sum(self.map_block_count[:count])
+        self.total_block_count -= skipped
 
-    def get_lbn_for_vbn(self, vbn):
+        self.map_lbn = self.map_lbn[count:]
+        self.map_block_count = self.map_block_count[count:]
+        self.map_base = [base - skipped for base in self.map_base[count:]]
+
+    def get_lbn_runs(self, vbn: int, count: int) -> Iterator[Tuple[int, int]]:
+        """Yield (lbn, count) for each physically contiguous run of blocks
+        covering VBNs vbn through vbn + count - 1."""
         vbn -= 1
+        end_vbn = vbn + count
 
-        base_block_count = 0
-        for ptr in self.map:
-            r = range(base_block_count, base_block_count + ptr['block_count'])
-            if vbn in r:
-                return ptr['lbn'] + (vbn - base_block_count)
-            
-            base_block_count += ptr['block_count']
+        run_lbn: Optional[int] = None
+        run_count = 0
+
+        i = bisect_right(self.map_base, vbn) - 1
+        while vbn < end_vbn and i < len(self.map_lbn):
+            lbn = self.map_lbn[i] + (vbn - self.map_base[i])
+            n = min(self.map_base[i + 1], end_vbn) - vbn
+
+            if run_lbn is not None and run_lbn + run_count == lbn:
+                run_count += n
+            else:
+                if run_lbn is not None:
+                    yield (run_lbn, run_count)
+                run_lbn = lbn
+                run_count = n
+
+            vbn += n
+            i += 1
 
-    def get_record_by_name(self, name):
-        for r in self.records:
-            if r.name == name:
-                return r
+        if run_lbn is not None:
+            yield (run_lbn, run_count)
+
+    def get_block_offsets(self, vbn: int, count: int) -> Iterator[int]:
+        """Yield the disk offset of each block for VBNs vbn through
+        vbn + count - 1."""
+        for lbn, run_count in self.get_lbn_runs(vbn, count):
+            yield from range(lbn * BLOCK_SIZE, (lbn + run_count) * BLOCK_SIZE, BLOCK_SIZE)
+
+    def load_records(self) -> None:
+        if self.records_loaded:
+            return
+
+        self.records_loaded = True
+        if self.is_directory:
+            self.read_directory_records(self.disk)
+
+    def get_record_by_name(self, name: str) -> Optional[DirectoryRecord]:
+        self.load_records()
+        return self.records_by_name.get(name)
 
 class ODS2(Operations):
 
-    def __init__(self, filename, mountpoint):
+    def __init__(self, filename: str, mountpoint: str) -> None:
         file = open(filename, 'rb')
-        self.disk = file.read()
+        self.image = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.disk: memoryview = memoryview(self.image)
         file.close()
 
-        self.mountpoint = mountpoint
+        self.mountpoint: str = mountpoint
+        self.disk_stat: os.stat_result = os.lstat(filename)
+        self.path_cache: Dict[str, File] = {}
+
+        # Per-instance so the cache does not keep the ODS2 object alive. A
+        # miss costs one extra 512 byte copy over slicing the mapping, but a
+        # hit returns a heap copy without touching the mapping, which saves
+        # a page fault once the kernel has dropped the page.
+        self.read_block: Callable[[int], bytes] = functools.lru_cache(maxsize=4096)(self._read_block)
 
         print("Disk has {} Logical Blocks".format(int(len(self.disk) / BLOCK_SIZE)))
 
         self.read_home_block()
 
-    def read_home_block(self):
-        FORMAT = '<IIIHHHHHHIIHHHHHHI4xHH2xHQBBHQQQ20s20s320xI12s12s12s12s2xH'
+    def read_home_block(self) -> None:
         (
-            L_HOMELBN,
-            L_ALHOMELBN,
-            L_ALTIDXLBN,
-            W_STRUCLEV,
-            W_CLUSTER,
-            W_HOMEVBN,
-            W_ALHOMEVBN,
-            W_ALTIDXVBN,
-            W_IBMAPVBN,
             L_IBMAPLBN,
-            L_MAXFILES,
             W_IBMAPSIZE,
             W_RESFILES,
-            W_DEVTYPE,
-            W_RVN,
-            W_SETCOUNT,
-            W_VOLCHAR,
-            L_VOLOWNER,
-            W_PROTECT,
-            W_FILEPROT,
-            W_CHECKSUM1,
-            Q_CREDATE,
-            B_WINDOW,
-            B_LRU_LIM,
-            W_EXTEND,
-            Q_RETAINMIN,
-            Q_RETAINMAX,
-            Q_REVDATE,
-            R_MIN_CLASS,
-            R_MAX_CLASS,
-            L_SERIALNUM,
             T_STRUCNAME,
             T_VOLNAME,
             T_OWNERNAME,
             T_FORMAT,
-            W_CHECKSUM2,
-        ) = struct.unpack_from(FORMAT, self.disk, BLOCK_SIZE)
+        ) = _HOME_S.unpack_from(self.disk, BLOCK_SIZE)
 
         self.structure_name = T_STRUCNAME.decode("ascii")
         self.volume_name = T_VOLNAME.decode("ascii")
         self.owner_name = T_OWNERNAME.decode("ascii")
         self.format = T_FORMAT.decode("ascii")
-        self.reserved_file_count = W_RESFILES
+        self.reserved_file_count: int = W_RESFILES
 
-        self.bitmap_blocks = W_IBMAPSIZE
+        self.bitmap_blocks: int = W_IBMAPSIZE
 
         print("Structure Name: {}".format(self.structure_name))
         print("Volume Name: {}".format(self.volume_name))
@@ -322,43 +341,47 @@ class ODS2(Operations):
         self.index_file = File(self.disk, index_offset)
 
         # Skip the first 3 clusters
-        for m in self.index_file.map[:3]:
-            self.index_file.total_block_count -= m['block_count']
-        self.index_file.map = self.index_file.map[3:]
+        self.index_file.skip_extents(3)
 
         count = 0
 
-        self.mfd = None
-        self.files = [None] * self.index_file.total_block_count
-        for vbn in range(1, self.index_file.total_block_count):
-            lbn = self.index_file.get_lbn_for_vbn(self.bitmap_blocks + vbn)
-            offset = lbn * BLOCK_SIZE
-
+        mfd: Optional[File] = None
+        self.files: List[Optional[File]] = [None] * self.index_file.total_block_count
+        header_offsets = self.index_file.get_block_offsets(self.bitmap_blocks + 1, self.index_file.total_block_count - 1)
+        for offset in header_offsets:
             if self.disk[offset] == 0:
                 break
             
             file = File(self.disk, offset)
             if file.name == '000000.DIR':
-                self.mfd = file
+                mfd = file
 
             index = file.fid.file_number - 1
             if index == -1:
                 continue
 
-            self.files[index] = File(self.disk, offset)
+            self.files[index] = file
             count += 1
 
         print("Read {} files".format(count))
 
+        if mfd is None:
+            raise ValueError("Master File Directory 000000.DIR not found")
+
+        self.mfd: File = mfd
         self.mfd.size = 666
 
-    def get_file_by_path(self, path):
+    def get_file_by_path(self, path: str) -> Optional[File]:
         if path.startswith('/'):
             path = path[1:]
 
         if path.endswith('/'):
             path = path[:-1]
 
+        file = self.path_cache.get(path)
+        if file is not None:
+            return file
+
         parts = []
         if len(path) > 0:
             parts = path.split('/')
@@ -366,14 +389,23 @@ class ODS2(Operations):
         file = self.mfd
         for p in parts:
             rec = file.get_record_by_name(p)
-            index = rec.entries[0].fid.file_number - 1
-            file = self.files[index]
-        return file
+            if rec is None:
+                return None
+
+            index = rec.entries[0].file_number - 1
+            child = self.files[index]
+            if child is None:
+                return None
+
+            file = child
 
-    def getattr(self, path, fh):
-        disk_st = os.lstat(sys.argv[1])
+        self.path_cache[path] = file
+        return file
 
+    def getattr(self, path: str, fh: Any) -> Dict[str, Any]:
         file = self.get_file_by_path(path)
+        if file is None:
+            raise FuseOSError(errno.ENOENT)
 
         st = {
             'st_size': file.size,
@@ -382,8 +414,8 @@ class ODS2(Operations):
             'st_mtime': file.revision_time,
             'st_mode': S_IFREG | 0o444,
             'st_nlink': 0,
-            'st_uid': disk_st.st_uid,
-            'st_gid': disk_st.st_gid,
+            'st_uid': self.disk_stat.st_uid,
+            'st_gid': self.disk_stat.st_gid,
         }
 
         if file.is_directory:
@@ -391,27 +423,35 @@ class ODS2(Operations):
 
         return st
 
-    def readdir(self, path, fh):
+    def readdir(self, path: str, fh: Any) -> Iterator[str]:
         dirents = ['.', '..']
         file = self.get_file_by_path(path)
+        if file is None:
+            raise FuseOSError(errno.ENOENT)
+
+        file.load_records()
 
         for r in file.records:
-            file_number = r.entries[0].fid.file_number
+            file_number = r.entries[0].file_number
             if file_number <= self.reserved_file_count:
                 continue
             
             dirents.append(r.name)
 
-        for r in dirents:
-            yield r
+        for dirent in dirents:
+            yield dirent
 
-    def readlink(self, path):
+    def readlink(self, path: str) -> str:
         if path == '/000000.DIR':
             return self.mountpoint
 
         return ''
 
-    def read(self, path, length, offset, fh):
+    def _read_block(self, lbn: int) -> bytes:
+        disk_offset = lbn * BLOCK_SIZE
+        return bytes(self.disk[disk_offset:disk_offset + BLOCK_SIZE])
+
+    def read(self, path: str, length: int, offset: int, fh: Any) -> bytes:
         if (offset % BLOCK_SIZE) != 0:
             print("unaligned offset")
             return bytes()
@@ -420,23 +460,31 @@ class ODS2(Operations):
         if file == None:
             return bytes()
 
-        data = bytearray()
-
-        data_offset = 0
         end_offset = offset + length
         if end_offset > file.size:
             end_offset = file.size
 
-        while offset < end_offset:
-            vbn = int(offset / BLOCK_SIZE) + 1
-            lbn = file.get_lbn_for_vbn(vbn)
-            disk_offset = lbn * BLOCK_SIZE
-            data[data_offset:data_offset + BLOCK_SIZE] = self.disk[disk_offset:disk_offset + BLOCK_SIZE]
+        if offset >= end_offset:
+            return bytes()
 
-            offset += BLOCK_SIZE
-            data_offset += BLOCK_SIZE
+        data = bytearray(end_offset - offset)
+        view = memoryview(data)
 
-        return bytes(data)
+        data_offset = 0
+        vbn = (offset // BLOCK_SIZE) + 1
+        block_count = -(-len(data) // BLOCK_SIZE)
+        for lbn, count in file.get_lbn_runs(vbn, block_count):
+            size = min(count * BLOCK_SIZE, len(data) - data_offset)
+            if count == 1:
+                # Repeated small reads of the same block are served from the
+                # block cache
+                view[data_offset:data_offset + size] = self.read_block(lbn)[:size]
+            else:
+                disk_offset = lbn * BLOCK_SIZE
+                view[data_offset:data_offset + size] = self.disk[disk_offset:disk_offset + size]
+            data_offset += size
+
+        return bytes(view[:data_offset])
 
 if __name__ == '__main__':
     FUSE(ODS2(sys.argv[1], sys.argv[2]), sys.argv[2], nothreads=True, foreground=True)